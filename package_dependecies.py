@@ -1,112 +1,327 @@
 import os
+import time
+import shelve
 import shutil
+import hashlib
+import json
 import requests
 import subprocess
 import yaml
 import argparse
-from tempfile import mkdtemp
-from concurrent.futures import ThreadPoolExecutor
-
-def get_default_branch(owner, repo):
-    """Fetch the default branch of a repository."""
-    url = f"https://api.github.com/repos/{owner}/{repo}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.json().get("default_branch", "main")
-    else:
-        print(f"Error fetching default branch: {response.status_code}")
-        return "main"  # Fallback to "main"
-
-def fetch_tree_with_git(repo_url, branch=None, temp_dir=None):
-    """Clone the repository and fetch the tree structure."""
-    # Extract owner and repo from URL
-    parts = repo_url.rstrip('.git').split('/')
-    owner, repo = parts[-2], parts[-1]
+import threading
+from contextlib import ExitStack
+from tempfile import mkdtemp, TemporaryFile
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader
+
+GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
+
+# Workers are bound by network round trips, not CPU, but GitHub penalizes
+# too many concurrent requests
+DEFAULT_MAX_THREADS = min(32, (os.cpu_count() or 4) * 4)
+
+# Shared session so the workers reuse keep-alive connections to GitHub
+SESSION = requests.Session()
+
+def configure_session(pool_connections=8, pool_maxsize=DEFAULT_MAX_THREADS * 2):
+    """Size the connection pools of the shared session.
+
+    pool_maxsize should cover the worker threads, otherwise urllib3 discards
+    connections instead of keeping them alive.
+    """
+    SESSION.mount("https://", HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                          raise_on_status=False)
+    ))
+
+configure_session()
+
+# Clones are far heavier than API calls, bound them separately from the
+# worker threads so the pool can be sized for the network round trips
+CLONE_SLOTS = threading.BoundedSemaphore(4)
+
+# Shelve objects are not thread safe
+CACHE_LOCK = threading.Lock()
 
-    # Get default branch if not provided
-    if not branch:
-        branch = get_default_branch(owner, repo)
+# Serializes git operations on the mirror of each repository URL
+REPO_LOCKS = {}
 
-    # Clone the repository metadata to the temporary directory
-    repo_download_path = os.path.join(temp_dir, f"{owner}-{repo}-{branch}-bare")
-    subprocess.run(["git", "clone", "--bare", repo_url, repo_download_path], check=True)
+# Fail instead of prompting for credentials on private or moved repositories
+GIT_ENV = {**os.environ, "GIT_TERMINAL_PROMPT": "0"}
 
+def github_api_headers():
+    """Return the headers for a GitHub REST API request."""
+    headers = {"Accept": "application/vnd.github+json"}
+    if GITHUB_TOKEN:
+        headers["Authorization"] = f"Bearer {GITHUB_TOKEN}"
+    return headers
+
+def parse_repo_url(repo_url):
+    """Extract the owner and repo name from a repository URL."""
+    return repo_url.removesuffix(".git").rsplit("/", 2)[-2:]
+
+def is_file_match(file_path, filename):
+    """Check whether the path points to a file with the given name."""
+    return file_path == filename or file_path.endswith("/" + filename)
+
+def fetch_tree_with_api(owner, repo, branch, filename):
+    """Fetch the paths of a file in a GitHub repository with the trees API.
+
+    Returns None if the listing could not be fetched or was truncated.
+    """
+    url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{branch}?recursive=1"
+    try:
+        response = SESSION.get(url, headers=github_api_headers())
+    except requests.RequestException as e:
+        print(f"Error fetching tree of {owner}/{repo}: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Error fetching tree of {owner}/{repo}: {response.status_code}")
+        return None
+
+    data = response.json()
+    if data.get("truncated"):
+        print(f"Tree of {owner}/{repo} is truncated, falling back to git")
+        return None
+    return [
+        entry["path"] for entry in data["tree"]
+        if entry["type"] == "blob" and is_file_match(entry["path"], filename)
+    ]
+
+def resolve_commit_sha(repo_url, branch):
+    """Resolve the branch of the repository to a commit SHA with git ls-remote."""
     result = subprocess.run(
-        ["git", "ls-tree", "-r", "--name-only", branch],
-        cwd=repo_download_path,
+        # The peeled pattern makes ls-remote list the commit of annotated tags
+        ["git", "-c", "protocol.version=2", "ls-remote", repo_url, branch, f"{branch}^{{}}"],
+        env=GIT_ENV,
         capture_output=True,
         text=True
     )
-    if result.returncode != 0:
-        print(f"Error: {result.stderr}")
+    if result.returncode != 0 or not result.stdout:
+        return None
+
+    refs = {}
+    for line in result.stdout.splitlines():
+        sha, ref = line.split("\t")
+        refs[ref] = sha
+    # Prefer a branch over a tag of the same name, and a tag's commit over the tag.
+    # ls-remote also matches ref tails like refs/heads/release/<branch>, those
+    # are left unresolved rather than cached under the wrong commit
+    for ref in (branch, f"refs/heads/{branch}", f"refs/tags/{branch}^{{}}", f"refs/tags/{branch}"):
+        if ref in refs:
+            return refs[ref]
+    return None
+
+def query_commit_shas(repos):
+    """Query the commit SHAs of (repo_url, branch) pairs in one GraphQL request."""
+    fields = []
+    for i, (repo_url, branch) in enumerate(repos):
+        owner, repo = parse_repo_url(repo_url)
+        fields.append(
+            f"r{i}: repository(owner: {json.dumps(owner)}, name: {json.dumps(repo)}) "
+            f"{{ object(expression: {json.dumps(branch)}) {{ oid ... on Tag {{ target {{ oid }} }} }} }}"
+        )
+    # The SHAs only key the cache, a failed query leaves them to git ls-remote
+    try:
+        response = SESSION.post(
+            "https://api.github.com/graphql",
+            json={"query": "query { " + " ".join(fields) + " }"},
+            headers=github_api_headers()
+        )
+        if response.status_code != 200:
+            print(f"Error querying commit SHAs: {response.status_code}")
+            return {}
+        data = response.json().get("data") or {}
+    except (requests.RequestException, ValueError) as e:
+        print(f"Error querying commit SHAs: {e}")
+        return {}
+
+    # Repositories that can't be resolved come back as null
+    shas = {}
+    for i, key in enumerate(repos):
+        obj = (data.get(f"r{i}") or {}).get("object")
+        if obj:
+            shas[key] = obj.get("target", obj)["oid"]
+    return shas
+
+def resolve_github_commit_shas(repos, executor, batch_size=25):
+    """Resolve the branches of GitHub repositories to commit SHAs in batches.
+
+    The GraphQL API needs a token, without GITHUB_TOKEN nothing is resolved.
+    """
+    if not GITHUB_TOKEN:
+        return {}
+    batches = [repos[i:i + batch_size] for i in range(0, len(repos), batch_size)]
+    shas = {}
+    for batch_shas in executor.map(query_commit_shas, batches):
+        shas.update(batch_shas)
+    return shas
+
+def fetch_tree_with_git(repo_url, branch=None, temp_dir=None, sha=None, filename="package.xml"):
+    """Fetch the paths of a file in the repository.
+
+    Repositories that can't be listed through the API are mirrored in temp_dir.
+    If the commit SHA of the branch is known the API lists that exact commit.
+    """
+    # Extract owner and repo from URL
+    owner, repo = parse_repo_url(repo_url)
+
+    # HEAD resolves to the default branch for git, the API and raw URLs alike
+    branch = branch or "HEAD"
+
+    # A single API call returns the whole tree for GitHub hosted repositories
+    if urlparse(repo_url).netloc == "github.com":
+        files = fetch_tree_with_api(owner, repo, sha or branch, filename)
+        if files is not None:
+            return files, branch
+
+    # One mirror per repository URL is shared by all of its branches, the
+    # URL hash keeps hosts with the same owner and repo name apart
+    mirror_key = hashlib.sha1(repo_url.encode()).hexdigest()
+    mirror_path = os.path.join(temp_dir, f"{owner}-{repo}-{mirror_key}-bare")
+    with REPO_LOCKS.setdefault(mirror_key, threading.Lock()), CLONE_SLOTS:
+        if not os.path.isdir(mirror_path):
+            # Clone only the tip tree metadata of the branch
+            branch_args = [] if branch == "HEAD" else ["--branch", branch]
+            subprocess.run(
+                ["git", "-c", "protocol.version=2", "clone", "--bare", "--filter=blob:none",
+                 "--depth=1", "--single-branch", *branch_args, "--no-tags",
+                 repo_url, mirror_path],
+                env=GIT_ENV,
+                check=True
+            )
+            ref = "HEAD"
+        else:
+            # Fetch the branch into the existing mirror, reusing its objects
+            subprocess.run(
+                ["git", "-c", "protocol.version=2", "fetch", "--filter=blob:none",
+                 "--depth=1", "--no-tags", "origin", branch],
+                cwd=mirror_path,
+                env=GIT_ENV,
+                check=True
+            )
+            ref = "FETCH_HEAD"
+
+        # Match the paths while git lists them rather than buffering the listing.
+        # stderr goes to a file so git can't block on it while stdout is read
+        with TemporaryFile("w+") as stderr_file:
+            proc = subprocess.Popen(
+                ["git", "ls-tree", "-r", "--name-only", ref],
+                cwd=mirror_path,
+                stdout=subprocess.PIPE,
+                stderr=stderr_file,
+                text=True
+            )
+            try:
+                files = [
+                    file_path for file_path in (line.rstrip("\n") for line in proc.stdout)
+                    if is_file_match(file_path, filename)
+                ]
+            finally:
+                proc.stdout.close()
+                proc.wait()
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+    if proc.returncode != 0:
+        print(f"Error: {stderr}")
         return None, None
 
-    # Parse the tree structure
-    files = result.stdout.splitlines()
-    tree = {}
-    for file in files:
-        parts = file.split("/")
-        current = tree
-        for part in parts[:-1]:
-            current = current.setdefault(part, {})
-        current[parts[-1]] = "file"
-    return tree, branch
-
-def find_all_files_in_tree(tree, filename, path=""):
-    """Recursively search for all instances of a file in the tree structure."""
-    found_files = []
-    for key, value in tree.items():
-        current_path = f"{path}/{key}" if path else key
-        if key == filename:
-            folder_name = path.split("/")[-1] if "/" in path else path
-            found_files.append((folder_name, current_path))
-        elif isinstance(value, dict):  # It's a folder
-            found_files.extend(find_all_files_in_tree(value, filename, current_path))
-    return found_files
-
-def create_raw_url(owner, repo, branch, file_path):
-    """Construct the raw.githubusercontent.com URL for a file."""
-    raw_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/{file_path}"
-    return raw_url
-
-def get_package_dependencies(repo_url, branch, temp_dir, filename_to_find="package.xml"):
-    """Fetch package dependencies and construct raw URLs."""
-    # Fetch tree and branch
-    tree_structure, branch = fetch_tree_with_git(repo_url, branch, temp_dir)
+    return files, branch
+
+def find_root_file(repo_url, branch, filename="package.xml"):
+    """Return the raw URL of the file at the root of a GitHub repository, if present."""
+    if urlparse(repo_url).netloc != "github.com":
+        return None
+    owner, repo = parse_repo_url(repo_url)
+    raw_url = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch or 'HEAD'}/{filename}"
+    try:
+        response = SESSION.head(raw_url, allow_redirects=True)
+    except requests.RequestException:
+        return None
+    return raw_url if response.status_code == 200 else None
+
+def get_package_dependencies(repo_url, branch, temp_dir, filename_to_find="package.xml",
+                             cache=None, cache_ttl=3600, sha=None):
+    """Fetch package dependencies and construct raw URLs.
+
+    Found files are stored in cache, if given, keyed by the commit the branch
+    points to, so an unchanged repository is never fetched twice. Branches that
+    can't be resolved are cached by name for cache_ttl seconds. The commit SHA
+    is resolved with git ls-remote unless it is already given.
+    """
+    branch = branch or "HEAD"
+
+    found_files = None
+    if cache is not None:
+        sha = sha or resolve_commit_sha(repo_url, branch)
+        cache_key = hashlib.sha1(f"{repo_url}@{sha or branch}:{filename_to_find}".encode()).hexdigest()
+        with CACHE_LOCK:
+            entry = cache.get(cache_key)
+        if entry and (sha or time.time() - entry[0] < cache_ttl):
+            found_files = entry[1]
 
     # Extract owner and repo
-    parts = repo_url.rstrip('.git').split('/')
-    owner, repo = parts[-2], parts[-1]
+    owner, repo = parse_repo_url(repo_url)
 
     results = {}
 
-    # Find all instances of the file and construct URLs
-    if tree_structure:
-        found_files = find_all_files_in_tree(tree_structure, filename_to_find)
-        if found_files:
-            for folder_name, file_path in found_files:
-                raw_url = create_raw_url(owner, repo, branch, file_path)
-                if not folder_name:
-                    folder_name = repo
-                results[folder_name] = raw_url
-    else:
-        print(f"Failed to fetch the repository structure: {repo_url}")
+    if found_files is None:
+        # Fetch file list and branch
+        files, branch = fetch_tree_with_git(repo_url, branch, temp_dir, sha, filename_to_find)
+        if files is None:
+            print(f"Failed to fetch the repository structure: {repo_url}")
+            return results
 
-    return results
+        # Take the folder of each instance of the file
+        found_files = [
+            (file_path.rsplit("/", 2)[-2] if "/" in file_path else "", file_path)
+            for file_path in files
+        ]
+        if cache is not None:
+            with CACHE_LOCK:
+                cache[cache_key] = (time.time(), found_files)
+
+    # Construct the raw.githubusercontent.com URLs
+    url_prefix = f"https://raw.githubusercontent.com/{owner}/{repo}/{branch}/"
+    for folder_name, file_path in found_files:
+        raw_url = url_prefix + file_path
+        if not folder_name:
+            folder_name = repo
+        results[folder_name] = raw_url
 
-def parse_and_validate_yaml(distro_yaml_path, output_file, max_threads=15):
-    """Parse the distro.yaml, validate repositories, and store results."""
-    # Delete the output file if it exists
-    if os.path.exists(output_file):
-        os.remove(output_file)
+    return results
 
-    with open(distro_yaml_path, "r") as yaml_file:
-        distro_data = yaml.safe_load(yaml_file)
+def parse_and_validate_yaml(distro_yaml_path, output_file, max_threads=DEFAULT_MAX_THREADS,
+                            cache_file="tree_cache", cache_ttl=3600, mirror_dir=None,
+                            pool_connections=8):
+    """Parse the package list, validate repositories, and store results."""
+    # Keep a pooled connection per worker thread
+    configure_session(pool_connections, max_threads * 2)
 
-    # Temporary directory for bare repositories
-    temp_dir = mkdtemp()
+    # Package lists are JSON, YAML ones are still read for compatibility
+    with open(distro_yaml_path, "rb") as pkglist_file:
+        if distro_yaml_path.endswith(".json"):
+            distro_data = json_loads(pkglist_file.read())
+        else:
+            distro_data = yaml.load(pkglist_file, Loader=SafeLoader)
 
     reconciliation_report = {"total": 0, "matched": 0, "mismatched": 0, "unmatched": 0}
+    # Guards the report counters and the output file shared by the workers
+    lock = threading.Lock()
 
     def process_repo(repo_name, repo_data):
         nonlocal reconciliation_report
@@ -114,34 +329,80 @@ def parse_and_validate_yaml(distro_yaml_path, output_file, max_threads=15):
 
         repo_url = repo_data.get("url")
         if not repo_url:
-            reconciliation_report["unmatched"] += 1
+            with lock:
+                reconciliation_report["unmatched"] += 1
             return
 
-        branch = repo_data.get("version", "main")
+        branch = repo_data.get("version") or "HEAD"
 
-        dependencies = get_package_dependencies(repo_url, branch, temp_dir)
+        # Most repositories hold a single package named after the repository
+        # at their root, a HEAD request is enough to confirm that
+        dependencies = None
+        repo = parse_repo_url(repo_url)[1]
+        if repo_data.get("packages", []) == [repo]:
+            raw_url = find_root_file(repo_url, branch)
+            if raw_url:
+                dependencies = {repo: raw_url}
+
+        if dependencies is None:
+            dependencies = get_package_dependencies(repo_url, branch, temp_dir,
+                                                    cache=cache, cache_ttl=cache_ttl,
+                                                    sha=shas.get((repo_url, branch)))
+        matched = mismatched = 0
         for folder_name, raw_url in dependencies.items():
             if folder_name in repo_data.get("packages", []):
                 key_value_results[folder_name] = raw_url
-                reconciliation_report["matched"] += 1
+                matched += 1
             else:
-                reconciliation_report["mismatched"] += 1
+                mismatched += 1
 
-        # Update reconciliation totals
-        reconciliation_report["total"] += len(repo_data.get("packages", []))
+        with lock:
+            # Update reconciliation totals
+            reconciliation_report["matched"] += matched
+            reconciliation_report["mismatched"] += mismatched
+            reconciliation_report["total"] += len(repo_data.get("packages", []))
 
-        # Incrementally save results to the output file
-        with open(output_file, "a") as result_file:
+            # Incrementally save results to the output file
             for key, value in key_value_results.items():
                 result_file.write(f"{key} => {value}\n")
 
+    # Releases whatever was set up below, even if a later step fails
+    cleanup = ExitStack()
     try:
+        # Directory for bare repositories, temporary unless kept between runs
+        if mirror_dir:
+            os.makedirs(mirror_dir, exist_ok=True)
+            temp_dir = mirror_dir
+        else:
+            temp_dir = mkdtemp()
+            cleanup.callback(shutil.rmtree, temp_dir)
+
+        # Persistent cache of found files, shared by runs for different distros
+        cache = cleanup.enter_context(shelve.open(cache_file))
+
+        # One buffered output file for all workers, replacing any previous results
+        result_file = cleanup.enter_context(open(output_file, "w", buffering=1 << 16))
+
         with ThreadPoolExecutor(max_threads) as executor:
-            for repo_name, repo_data in distro_data.items():
-                executor.submit(process_repo, repo_name, repo_data)
+            # Resolve the GitHub repositories in a few batched queries up front
+            github_repos = sorted({
+                (repo_data["url"], repo_data.get("version") or "HEAD")
+                for repo_data in distro_data.values()
+                if repo_data.get("url") and urlparse(repo_data["url"]).netloc == "github.com"
+            })
+            shas = resolve_github_commit_shas(github_repos, executor)
+
+            futures = {
+                executor.submit(process_repo, repo_name, repo_data): repo_name
+                for repo_name, repo_data in distro_data.items()
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error processing {futures[future]}: {e}")
     finally:
-        # Clean up temporary directory
-        shutil.rmtree(temp_dir)
+        cleanup.close()
 
     # Print reconciliation report
     print("\nReconciliation Report:")
@@ -151,11 +412,17 @@ def parse_and_validate_yaml(distro_yaml_path, output_file, max_threads=15):
     print(f"Unmatched Repositories: {reconciliation_report['unmatched']}")
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Parse distro.yaml and validate package dependencies.")
-    parser.add_argument("pkglist", type=str, help="Path to the distro.yaml file.")
+    parser = argparse.ArgumentParser(description="Parse a package list and validate package dependencies.")
+    parser.add_argument("pkglist", type=str, help="Path to the <distro>_packages.json or .yaml file.")
     parser.add_argument("output", type=str, help="Path to the output file.")
-    parser.add_argument("--max-threads", type=int, default=15, help="Maximum number of concurrent threads (default: 15).")
+    parser.add_argument("--max-threads", type=int, default=DEFAULT_MAX_THREADS, help=f"Maximum number of concurrent threads (default: {DEFAULT_MAX_THREADS}).")
+    parser.add_argument("--pool-connections", type=int, default=8, help="Number of hosts to keep connection pools for (default: 8).")
+    parser.add_argument("--cache-file", type=str, default="tree_cache", help="Path of the repository file list cache (default: tree_cache).")
+    parser.add_argument("--cache-ttl", type=int, default=3600, help="Seconds a cached file list of an unresolved branch stays valid (default: 3600).")
+    parser.add_argument("--mirror-dir", type=str, default=None, help="Keep the bare repository mirrors in this directory between runs.")
 
     args = parser.parse_args()
 
-    parse_and_validate_yaml(args.pkglist, args.output, args.max_threads)
+    parse_and_validate_yaml(args.pkglist, args.output, args.max_threads,
+                            args.cache_file, args.cache_ttl, args.mirror_dir,
+                            args.pool_connections)
@@ -1,53 +1,230 @@
 import os
 import requests
 import yaml
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def distro_dist_search(distro):
+try:
+    from orjson import dumps as json_dumps
+except ImportError:
+    import json
+
+    def json_dumps(data):
+        return json.dumps(data).encode()
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader, SafeDumper
+
+try:
+    import ryml
+except ImportError:
+    ryml = None
+
+try:
+    # Revalidate distribution.yaml with its ETag instead of downloading it again.
+    # The cached session buffers the whole body, so streamed parsing then
+    # works on an in-memory copy rather than overlapping the download
+    import requests_cache
+    SESSION = requests_cache.CachedSession(
+        "rosdistro_cache", backend="sqlite", cache_control=True, expire_after=3600
+    )
+except ImportError:
+    SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                      raise_on_status=False)
+))
+
+RESOLVER = yaml.resolver.Resolver()
+
+def compose_node(events, event, anchors):
+    """Compose the YAML node started by event from the following parser events.
+
+    Anchored nodes are registered in anchors so later aliases resolve to them.
+    """
+    if isinstance(event, yaml.AliasEvent):
+        if event.anchor not in anchors:
+            raise yaml.YAMLError(f"Found undefined alias {event.anchor!r}")
+        return anchors[event.anchor]
+    if isinstance(event, yaml.ScalarEvent):
+        tag = event.tag if event.tag not in (None, "!") else RESOLVER.resolve(
+            yaml.ScalarNode, event.value, event.implicit)
+        node = yaml.ScalarNode(tag, event.value, style=event.style)
+    elif isinstance(event, yaml.SequenceStartEvent):
+        tag = event.tag if event.tag not in (None, "!") else RESOLVER.resolve(
+            yaml.SequenceNode, None, event.implicit)
+        node = yaml.SequenceNode(tag, [])
+        if event.anchor is not None:
+            anchors[event.anchor] = node
+        for item in events:
+            if isinstance(item, yaml.SequenceEndEvent):
+                break
+            node.value.append(compose_node(events, item, anchors))
+        return node
+    elif isinstance(event, yaml.MappingStartEvent):
+        tag = event.tag if event.tag not in (None, "!") else RESOLVER.resolve(
+            yaml.MappingNode, None, event.implicit)
+        node = yaml.MappingNode(tag, [])
+        if event.anchor is not None:
+            anchors[event.anchor] = node
+        for key in events:
+            if isinstance(key, yaml.MappingEndEvent):
+                break
+            node.value.append((compose_node(events, key, anchors),
+                               compose_node(events, next(events), anchors)))
+        return node
+    else:
+        raise yaml.YAMLError(f"Unsupported YAML event: {event}")
+    if event.anchor is not None:
+        anchors[event.anchor] = node
+    return node
+
+def iter_repositories(stream):
+    """Yield the name and data of each repository while the stream is parsed."""
+    constructor = yaml.constructor.SafeConstructor()
+    events = iter(yaml.parse(stream, Loader=SafeLoader))
+    # Anchors stay valid for the whole document, not just one repository
+    anchors = {}
+
+    # Skip the stream and document start up to the top level mapping
+    for event in events:
+        if isinstance(event, yaml.MappingStartEvent):
+            break
+
+    for key in events:
+        if isinstance(key, yaml.MappingEndEvent):
+            break
+        if key.value != "repositories":
+            compose_node(events, next(events), anchors)
+            continue
+        if not isinstance(next(events), yaml.MappingStartEvent):
+            break
+        for name in events:
+            if isinstance(name, yaml.MappingEndEvent):
+                break
+            node = compose_node(events, next(events), anchors)
+            yield name.value, constructor.construct_document(node)
+
+def ryml_scalar(tree, node, constructor):
+    """Convert a rapidyaml scalar the way the YAML loader would."""
+    if not tree.has_val(node) or tree.val(node) is None:
+        return None
+    value = bytes(tree.val(node)).decode()
+    if tree.is_val_quoted(node):
+        return value
+    tag = RESOLVER.resolve(yaml.ScalarNode, value, (True, False))
+    return constructor.construct_document(yaml.ScalarNode(tag, value))
+
+def iter_repositories_ryml(content):
+    """Yield the name and the used fields of each repository with rapidyaml.
+
+    Only the fields read by distro_dist_search are converted to Python objects,
+    the same way iter_repositories converts them.
+    """
+    constructor = yaml.constructor.SafeConstructor()
+    tree = ryml.parse_in_arena(content)
+    # Replace aliases and merge keys with the anchored nodes, like the YAML loader
+    tree.resolve()
+    root = tree.root_id()
+    # distribution.yaml has a %YAML directive, which makes the root a stream
+    if tree.is_stream(root):
+        root = tree.first_child(root)
+    repositories = tree.find_child(root, b"repositories")
+    if repositories == ryml.NONE:
+        return
+
+    fields = {
+        "source": ("type", "url", "version"),
+        "release": ("packages", "version"),
+    }
+    for node in ryml.children(tree, repositories):
+        name = bytes(tree.key(node)).decode()
+        if not tree.is_map(node):
+            yield name, ryml_scalar(tree, node, constructor)
+            continue
+        # An empty mapping stays falsy and is skipped, like in iter_repositories
+        if not tree.num_children(node):
+            yield name, {}
+            continue
+        package_info = {section: {} for section in fields}
+        for section, keys in fields.items():
+            section_node = tree.find_child(node, section.encode())
+            if section_node == ryml.NONE or not tree.is_map(section_node):
+                continue
+            values = package_info[section]
+            for key in keys:
+                child = tree.find_child(section_node, key.encode())
+                if child == ryml.NONE:
+                    continue
+                if tree.is_seq(child):
+                    values[key] = [ryml_scalar(tree, item, constructor)
+                                   for item in ryml.children(tree, child)]
+                else:
+                    values[key] = ryml_scalar(tree, child, constructor)
+        yield name, package_info
+
+def distro_dist_search(distro, as_yaml=False):
     distribution_yaml = f"https://raw.githubusercontent.com/ros/rosdistro/master/{distro}/distribution.yaml"
     
-    # Output YAML file
-    output_file = f"{distro}_packages.yaml"
-    
-    # Retrieve the file content from the URL
-    response = requests.get(distribution_yaml, allow_redirects=True)
-    response.raise_for_status()  # Raise an exception for HTTP errors
-    
-    # Convert bytes to string
-    content = response.content.decode("utf-8")
-    
-    # Load the YAML
-    content = yaml.safe_load(content)
-    
-    # Get the list of repositories
-    repositories = content.get("repositories", {})
+    # Output file, JSON unless a human readable YAML file is asked for
+    output_file = f"{distro}_packages.{'yaml' if as_yaml else 'json'}"
     
     # Dictionary to store consolidated package data
     consolidated_data = {}
     
-    for package_name, package_info in repositories.items():
-        if package_info:
-            source_info = package_info.get("source", {})
-            release_info = package_info.get("release", {})
-            git_url = source_info.get("url")
-            if not git_url:
-                print(f"Error: git_url is empty for package: {package_name}")
-                # continue
-                
-            # Prepare the package data
-            consolidated_data[package_name] = {
-                "type": source_info.get("type", "git"),
-                "url": git_url,
-                "version": source_info.get("version", None),
-                "packages": release_info.get("packages", [package_name]),
-                "package_version": release_info.get("version", None),
-            }
+    # Stream the file content from the URL, repositories are parsed as they arrive
+    # (with requests-cache the body is already fully read into memory)
+    with SESSION.get(distribution_yaml, allow_redirects=True, stream=True) as response:
+        response.raise_for_status()  # Raise an exception for HTTP errors
+        if ryml:
+            # rapidyaml parses the whole buffer at once but much faster
+            repositories = iter_repositories_ryml(response.content)
+        else:
+            response.raw.decode_content = True
+            repositories = iter_repositories(response.raw)
+    
+        for package_name, package_info in repositories:
+            if package_info:
+                source_info = package_info.get("source", {})
+                release_info = package_info.get("release", {})
+                git_url = source_info.get("url")
+                if not git_url:
+                    print(f"Error: git_url is empty for package: {package_name}")
+                    # continue
+                    
+                # Prepare the package data
+                consolidated_data[package_name] = {
+                    "type": source_info.get("type", "git"),
+                    "url": git_url,
+                    "version": source_info.get("version", None),
+                    "packages": release_info.get("packages", [package_name]),
+                    "package_version": release_info.get("version", None),
+                }
     
-    # Save the consolidated data to a YAML file
-    with open(output_file, "w") as yaml_file:
-        yaml.dump(consolidated_data, yaml_file, default_flow_style=False)
-    print(f"Consolidated YAML saved to {output_file}")
+    # Save the consolidated data
+    if as_yaml:
+        with open(output_file, "w") as yaml_file:
+            # Repositories keep the order of distribution.yaml, which is already sorted
+            yaml.dump(consolidated_data, yaml_file, Dumper=SafeDumper,
+                      default_flow_style=False, sort_keys=False)
+    else:
+        with open(output_file, "wb") as json_file:
+            json_file.write(json_dumps(consolidated_data))
+    print(f"Consolidated package list saved to {output_file}")
 
 DISTROS = ["rolling","jazzy"]
-for distro in DISTROS:
- print(f"Scraping from {distro}")
- distro_dist_search(distro)
\ No newline at end of file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the package lists of the ROS distros.")
+    parser.add_argument("--yaml", action="store_true", help="Write the package lists as YAML instead of JSON.")
+
+    args = parser.parse_args()
+
+    print(f"Scraping from {', '.join(DISTROS)}")
+    # The distros are independent downloads, fetch and parse them side by side
+    with ThreadPoolExecutor(len(DISTROS)) as executor:
+        list(executor.map(lambda distro: distro_dist_search(distro, args.yaml), DISTROS))